@@ -1,8 +1,13 @@
+import binascii
 import hmac
-import hashlib
+import json
 import logging
 import os
-from operator import itemgetter
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import sentry_sdk
 
@@ -20,6 +25,25 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Remote URL and primary checkout of each of the repos we act on
+_REPOS = {
+    "sentry": (SENTRY_REPO_URL, SENTRY_CHECKOUT_PATH),
+    "getsentry": (GETSENTRY_REPO_URL, GETSENTRY_CHECKOUT_PATH),
+}
+# Reverts fetch, commit and push; we do that work off the request thread
+_BACKGROUND_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="gitbot")
+# Syncs get their own worker so queued reverts cannot starve them
+_SYNC_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gitbot-sync")
+# If there were multiple requests very close to each other there's a chance
+# that more than one `git pull` would be executed at the same time on a primary repo
+_REPO_LOCKS = {repo: threading.Lock() for repo in _REPOS}
+# Results of the most recent revert jobs, keyed by job id
+MAX_REVERT_JOBS = 100
+_REVERT_JOBS = OrderedDict()
+_REVERT_JOBS_LOCK = threading.Lock()
+# Pushes to master and test-branch will be acted on
+_DEFAULT_BRANCHES = frozenset(("refs/heads/master", "refs/heads/test-branch"))
+
 
 def boot():
     if ENV != "development":
@@ -70,34 +94,49 @@ def boot():
 # Alias for updating the Sentry and Getsentry repos
 def update_primary_repo(repo):
     quiet = LOGGING_LEVEL != "debug"
-    if repo == "sentry":
-        update_checkout(SENTRY_REPO_URL, SENTRY_CHECKOUT_PATH, quiet)
-    else:
-        update_checkout(GETSENTRY_REPO_URL, GETSENTRY_CHECKOUT_PATH, quiet)
+    repo_url, checkout = _REPOS[repo]
+    update_checkout(repo_url, checkout, quiet)
 
 
-def respond(data, status_code):
-    logger.info(data)
+def respond(data, status_code, notify=None):
     if isinstance(data, str):
         data = {"reason": data}
-    if status_code != 200:
-        sentry_sdk.capture_message(data["reason"], "fatal")
+    logger.info("status=%s reason=%s", status_code, data.get("reason"))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(data)
+    # Expected 4xx outcomes (e.g. the code did not bump) are not worth a Sentry event
+    if notify is None:
+        notify = status_code >= 500
+    if notify:
+        level = "fatal" if status_code >= 500 else "warning"
+        sentry_sdk.capture_message(data["reason"], level)
     return jsonify(data), status_code
 
 
+def _safe_sync_upstream(checkout_path, upstream_url):
+    """Sync the Sentry test repo with upstream on the background executor"""
+    try:
+        # Reverts also work out of the primary Sentry checkout
+        with _REPO_LOCKS["sentry"]:
+            sync_with_upstream(checkout_path, upstream_url)
+    except Exception as e:
+        logger.warning(
+            "We failed to sync Sentry with Sentry Test Repo (We will keep going)"
+        )
+        logger.exception(e)
+        sentry_sdk.capture_exception(e)
+
+
 # Github's UI looks really bad when most responses are 400
 # Let's only turn it red when something actually goes bad
-def process_push():
+def process_push(data):
     """Handle "push" events to master branch"""
     # XXX: On what occassions would we want to use request.args.get("branches")?
-    # Pushes to master and test-branch will be acted on
-    branches = set(
-        f"refs/heads/{x}"
-        for x in (request.args.get("branches") or "master,test-branch").split(",")
-    )
-
-    data = request.get_json()
-    logger.info(data)
+    arg = request.args.get("branches")
+    if arg:
+        branches = frozenset(f"refs/heads/{x}" for x in arg.split(","))
+    else:
+        branches = _DEFAULT_BRANCHES
 
     if data.get("ref") not in branches:
         logger.info(f'{data.get("ref")} not in {branches}')
@@ -118,28 +157,22 @@ def process_push():
             )
             # This makes sentry-test-repo always keeping up with Sentry
             if ENV == "staging":
-                try:
-                    sync_with_upstream(
-                        SENTRY_CHECKOUT_PATH, repo_url("getsentry/sentry")
-                    )
-                except Exception as e:
-                    logger.warn(
-                        "We failed to sync Sentry with Sentry Test Repo (We will keep going)"
-                    )
-                    logger.exception(e)
+                _SYNC_EXECUTOR.submit(
+                    _safe_sync_upstream,
+                    SENTRY_CHECKOUT_PATH,
+                    repo_url("getsentry/sentry"),
+                )
         else:
             reason = "Unknown repository"
 
-    return respond(reason, status_code=200 if updated else 400)
+    # A failed bump on a tracked branch means getsentry did not get the change
+    return respond(reason, status_code=200 if updated else 400, notify=not updated)
 
 
 # Github's UI looks really bad when most responses are 400
 # Let's only turn it red when something actually goes bad
-def process_pull_request():
+def process_pull_request(data):
     """Handle "pull_request" events from PRs with the deploy marker set"""
-    data = request.get_json()
-    logger.info(data)
-
     action = data.get("action")
     if action not in ["synchronize", "opened"]:
         logger.info(f"Action: '{action}' not in 'synchronize' or 'opened'")
@@ -165,7 +198,7 @@ def process_pull_request():
             return respond("Pull request is already merged.", status_code=200)
 
     body = pull_request["body"] or ""
-    if body.find(GITBOT_MARKER) == -1:
+    if GITBOT_MARKER not in body:
         return respond("Deploy marker not found.", status_code=200)
 
     ref_sha = head["sha"]
@@ -178,11 +211,18 @@ def process_pull_request():
     return respond("Commit not relevant for deploy sync.", status_code=200)
 
 
-def valid_payload(secret: str, payload: str, signature: str) -> bool:
+def header_signature(header: str) -> str:
+    # Signature headers look like "sha1=<hexdigest>"
+    return header[5:] if header.startswith("sha1=") else header
+
+
+def valid_payload(secret: str, payload: bytes, signature: str) -> bool:
     # Validate payload signature
-    payload_signature = hmac.new(
-        secret.encode("utf-8"), payload, hashlib.sha1
-    ).hexdigest()
+    try:
+        signature = signature.encode("ascii")
+    except UnicodeEncodeError:
+        return False
+    payload_signature = binascii.hexlify(hmac_sha1(secret, payload).digest())
     return hmac.compare_digest(payload_signature, signature)
 
 
@@ -192,70 +232,139 @@ app = Flask(__name__)
 
 @app.route("/", methods=["POST"])
 def index():
+    # The raw body is cached by Werkzeug; we verify it and parse it only once
+    payload = request.get_data(cache=True)
     if GITHUB_WEBHOOK_SECRET and not valid_payload(
         GITHUB_WEBHOOK_SECRET,
-        request.data,
-        str(request.headers.get("X-Hub-Signature", "").replace("sha1=", "")),
+        payload,
+        header_signature(request.headers.get("X-Hub-Signature", "")),
     ):
-        return respond("Cannot validate payload signature.", status_code=403)
+        return respond(
+            "Cannot validate payload signature.", status_code=403, notify=True
+        )
 
     event_type = request.headers.get("X-GitHub-Event")
+    if event_type not in ("push", "pull_request"):
+        return respond("Unsupported event type.", status_code=200)
+
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return respond("Invalid JSON payload.", status_code=400)
+    if not isinstance(data, dict):
+        return respond("Invalid JSON payload.", status_code=400)
+    # The full payload can be tens of KB; only a summary is logged at the info level
+    logger.info(
+        "%s event repo=%s ref=%s sha=%s",
+        event_type,
+        (data.get("repository") or {}).get("full_name"),
+        data.get("ref"),
+        (data.get("head_commit") or {}).get("id"),
+    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("payload=%s", data)
 
     if event_type == "push":
-        return process_push()
-    elif event_type == "pull_request":
-        return process_pull_request()
+        return process_push(data)
     else:
-        return respond("Unsupported event type.", status_code=200)
+        return process_pull_request(data)
 
 
-def process_git_revert():
-    data = request.get_json()
-    repo, sha, name = itemgetter("repo", "sha", "name")(data)
+def process_git_revert(data):
+    repo = data["repo"]
+    sha = data["sha"]
     name = data["name"]
     logger.info(f"{name} has requested to revert {sha} from {repo}")
 
     tmp_dir = tempfile.mkdtemp()
-    repo_url = SENTRY_REPO_URL if repo == "sentry" else GETSENTRY_REPO_URL
-    checkout = SENTRY_CHECKOUT_PATH if repo == "sentry" else GETSENTRY_CHECKOUT_PATH
+    repo_url, checkout = _REPOS[repo]
 
-    # If there were multiple revert requests very close to each other there's a chance
-    # that more than one `git pull` would be executed at the same time
     update_checkout(repo_url, checkout)
 
-    # This avoids mutating the primary repo
-    run(f"git clone {checkout} {tmp_dir}")
-    execution = run(f'git log -1 --format="%s" {sha}', cwd=tmp_dir)
-    # "fix(search): Correct a few types on the frontend grammar parser (#26554)"
-    # "Revert "ref(snql) Update SDK to latest (#26638)""
-    subject = execution.stdout.replace('"', "")
-    if repo == "getsentry" and subject.startswith("getsentry/sentry@"):
-        body = f"{sha} cannot be reverted because it needs to be reverted in Sentry"
-        return respond(body, status_code=400)
-
-    run(f"git revert --no-commit {sha}", cwd=tmp_dir)
-    run(
-        [
-            "git",
-            "commit",
-            "-m",
-            f'Revert "{subject}"',
-            "-m",
-            f"This reverts commit {sha}.",
-            "-m",
-            f"Co-authored-by: {name}",
-        ],
-        cwd=tmp_dir,
-    )
+    # This avoids mutating the primary repo while sharing its object database
+    try:
+        run(
+            ["git", "worktree", "add", "--detach", tmp_dir, "origin/master"],
+            cwd=checkout,
+        )
+    except CommandError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    try:
+        execution = run(f'git log -1 --format="%s" {sha}', cwd=tmp_dir)
+        # "fix(search): Correct a few types on the frontend grammar parser (#26554)"
+        # "Revert "ref(snql) Update SDK to latest (#26638)""
+        subject = execution.stdout.replace('"', "")
+        if repo == "getsentry" and subject.startswith("getsentry/sentry@"):
+            body = f"{sha} cannot be reverted because it needs to be reverted in Sentry"
+            return {"reason": body}, 400
+
+        run(f"git revert --no-commit {sha}", cwd=tmp_dir)
+        run(
+            [
+                "git",
+                "commit",
+                "-m",
+                f'Revert "{subject}"',
+                "-m",
+                f"This reverts commit {sha}.",
+                "-m",
+                f"Co-authored-by: {name}",
+            ],
+            cwd=tmp_dir,
+        )
 
-    # Since we cloned from a local checkout we need to make sure to push to the remote repo
-    push_args = f"git push {repo_url}"
-    if DRY_RUN:
-        push_args += " --dry-run"
-    run(push_args, cwd=tmp_dir)
-    revert_sha = run("git rev-parse origin/master", cwd=tmp_dir).stdout
-    body = {"reason": f"{sha} reverted.", "revert_sha": revert_sha}
-    return respond(body, status_code=200)
+        # The worktree is detached, thus, we push its HEAD to the remote's master
+        push_args = f"git push {repo_url} HEAD:master"
+        if DRY_RUN:
+            push_args += " --dry-run"
+        run(push_args, cwd=tmp_dir)
+        revert_sha = run("git rev-parse HEAD", cwd=tmp_dir).stdout
+    finally:
+        try:
+            run(f"git worktree remove --force {tmp_dir}", cwd=checkout)
+        except CommandError as e:
+            # Do not mask the original error with a cleanup failure
+            logger.warning(f"Failed to remove the worktree at {tmp_dir}")
+            logger.exception(e)
+    return {"reason": f"{sha} reverted.", "revert_sha": revert_sha}, 200
+
+
+def _record_revert_job(job_id, result):
+    with _REVERT_JOBS_LOCK:
+        _REVERT_JOBS[job_id] = result
+        _REVERT_JOBS.move_to_end(job_id)
+        # Evict the oldest finished jobs; pending ones are still being polled
+        excess = len(_REVERT_JOBS) - MAX_REVERT_JOBS
+        if excess > 0:
+            finished = [
+                key
+                for key, (body, _) in _REVERT_JOBS.items()
+                if body["status"] != "pending"
+            ]
+            for key in finished[:excess]:
+                del _REVERT_JOBS[key]
+
+
+def _do_revert(job_id, data):
+    """Run a revert on the background executor and record its outcome"""
+    try:
+        with _REPO_LOCKS[data["repo"]]:
+            body, status_code = process_git_revert(data)
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        logger.exception(e)
+        body, status_code = {"reason": "Failed to revert."}, 400
+    else:
+        # Rejected reverts do not raise; we still want to hear about them
+        if status_code != 200:
+            sentry_sdk.capture_message(body["reason"], "warning")
+
+    logger.info(body)
+    status = "done" if status_code == 200 else "failed"
+    _record_revert_job(
+        job_id, ({"job_id": job_id, "status": status, **body}, status_code)
+    )
 
 
 @app.route("/api/revert", methods=["POST"])
@@ -263,13 +372,31 @@ def revert():
     if GITBOT_API_SECRET and not valid_payload(
         GITBOT_API_SECRET,
         request.data,
-        str(request.headers.get("X-Signature", "").replace("sha1=", "")),
+        header_signature(request.headers.get("X-Signature", "")),
     ):
-        return respond("Cannot validate payload signature.", status_code=403)
+        return respond(
+            "Cannot validate payload signature.", status_code=403, notify=True
+        )
 
-    try:
-        return process_git_revert()
-    except CommandError as e:
-        sentry_sdk.capture_exception(e)
-        logger.exception(e)
-        return respond("Failed to revert.", status_code=400)
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return respond("Invalid JSON payload.", status_code=400)
+    if data.get("repo") not in _REPOS:
+        return respond("Unknown repository", status_code=400)
+
+    job_id = uuid.uuid4().hex
+    body = {"reason": "Revert queued.", "job_id": job_id, "status": "pending"}
+    _record_revert_job(job_id, (body, 202))
+    _BACKGROUND_EXECUTOR.submit(_do_revert, job_id, data)
+    return respond(body, status_code=202)
+
+
+@app.route("/api/revert/status/<job_id>", methods=["GET"])
+def revert_status(job_id):
+    with _REVERT_JOBS_LOCK:
+        job = _REVERT_JOBS.get(job_id)
+    if job is None:
+        return respond("Unknown revert job.", status_code=404)
+    # The lookup itself succeeded; the outcome of the job lives in the body
+    body, _ = job
+    return jsonify(body), 200
@@ -1,7 +1,10 @@
+import hashlib
+import hmac
 import logging
 import os
 import subprocess
 import tempfile
+from functools import lru_cache
 
 from gitbot.config import (
     COMMITTER_EMAIL,
@@ -69,6 +72,19 @@ def run(cmd, cwd: str = "/tmp", quiet: bool = False) -> object:
     return execution
 
 
+@lru_cache(maxsize=None)
+def _keyed_hmac_sha1(secret: str) -> hmac.HMAC:
+    # The secrets live for the whole process; key once and clone the primed ipad/opad state
+    return hmac.new(secret.encode("utf-8"), b"", hashlib.sha1)
+
+
+def hmac_sha1(secret: str, payload: bytes) -> hmac.HMAC:
+    # hashlib is backed by OpenSSL which already dispatches to SHA-NI/ARMv8 crypto extensions
+    mac = _keyed_hmac_sha1(secret).copy()
+    mac.update(payload)
+    return mac
+
+
 def update_checkout(repo_url, checkout_path, quiet=False):
     logger.info(f"About to clone/pull to {checkout_path}.")
     if not os.path.exists(checkout_path):
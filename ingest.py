@@ -1,16 +1,17 @@
 #!/usr/bin/env python3
 #
 # This script can send POST requests to your development set up or the staging instance
-import hashlib
-import hmac
 import json
 import logging
 import os
 import sys
+import time
 
 import requests
 import click
-from requests.exceptions import ConnectionError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, HTTPError
+from urllib3.util.retry import Retry
 
 from gitbot.config import (
     GITBOT_API_SECRET,
@@ -18,7 +19,7 @@ from gitbot.config import (
     SENTRY_REPO,
     LOGGING_LEVEL,
 )
-from gitbot.lib import run
+from gitbot.lib import CommandError, hmac_sha1, run
 
 logging.basicConfig(format="%(levelname)-8s %(message)s")
 logger = logging.getLogger(__name__)
@@ -28,12 +29,34 @@ HOSTS = {
     "dev": "http://0.0.0.0",
     "staging": "https://sentry-deploy-sync-hook-staging-dwunkkvj6a-uc.a.run.app",
 }
+# How often and for how long we poll the status of a revert
+REVERT_POLL_INTERVAL = 2
+REVERT_POLL_TIMEOUT = 600
+
+# Reused across requests to keep connections alive; Cloud Run can return transient 5xx
+_SESSION = requests.Session()
+_SESSION.headers.update({"User-Agent": "gitbot-ingest"})
+_ADAPTER = HTTPAdapter(
+    pool_maxsize=4,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=frozenset(["POST"]),
+        raise_on_status=False,
+    ),
+)
+_SESSION.mount("http://", _ADAPTER)
+_SESSION.mount("https://", _ADAPTER)
+
+
+def encode_payload(payload) -> bytes:
+    # Compact and key-sorted so that the signed bytes are exactly the bytes we send
+    return json.dumps(payload, separators=(",", ":"), sort_keys=True).encode("utf-8")
 
 
 def signature(secret, payload):
-    return hmac.new(
-        secret.encode("utf-8"), json.dumps(payload).encode("utf-8"), hashlib.sha1
-    ).hexdigest()
+    return hmac_sha1(secret, encode_payload(payload)).hexdigest()
 
 
 def revert_payload_header(repo: str, sha: str, author: str, email: str):
@@ -68,6 +91,49 @@ def bump_payload_header(sha: str, author: str, email: str):
     return payload, header
 
 
+def git_user_config():
+    # A single git process for both user.name and user.email
+    try:
+        output = run(
+            r"git config --global --get-regexp ^user\.(name|email)$", quiet=True
+        ).stdout
+    except CommandError:
+        # git exits with an error when none of the keys are set
+        return {}
+    config = {}
+    for line in output.splitlines():
+        key, _, value = line.partition(" ")
+        config[key] = value
+    return config
+
+
+def git_author_email():
+    config = git_user_config()
+    # Fall back to asking git for each key that was not found
+    author = config.get("user.name")
+    if not author:
+        author = run("git config --global user.name", quiet=True).stdout
+    email = config.get("user.email")
+    if not email:
+        email = run("git config --global user.email", quiet=True).stdout
+    return author, email
+
+
+def wait_for_revert(host_url: str, job_id: str):
+    """Poll the status of a revert job until it is no longer pending"""
+    url = f"{host_url}/api/revert/status/{job_id}"
+    deadline = time.monotonic() + REVERT_POLL_TIMEOUT
+    while True:
+        resp = _SESSION.get(url)
+        resp.raise_for_status()
+        body = resp.json()
+        if body.get("status") != "pending":
+            return body
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Revert {job_id} is still pending; check {url}")
+        time.sleep(REVERT_POLL_INTERVAL)
+
+
 @click.command()
 @click.option("--host", default="dev", help="Host to test against.")
 @click.option("--port", help="The port to use.")  # Optional
@@ -92,8 +158,7 @@ def main(host, port, action, repo, sha, author, email):
 
     # We do not need to run this on CI
     if not (author and email) and not os.environ.get("CI"):
-        author = run("git config --global user.name", quiet=True).stdout
-        email = run("git config --global user.email", quiet=True).stdout
+        author, email = git_author_email()
 
     if action == "revert":
         payload, header = revert_payload_header(repo, sha, author, email)
@@ -112,9 +177,21 @@ def main(host, port, action, repo, sha, author, email):
     print(f"- header: {header}")
 
     try:
-        resp = requests.post(url, headers=header, json=payload)
+        resp = _SESSION.post(
+            url,
+            headers={"Content-Type": "application/json", **header},
+            data=encode_payload(payload),
+        )
         print(resp.text)
-    except ConnectionError as e:
+        # Reverts are processed in the background; wait for the outcome
+        if action == "revert" and resp.status_code == 202:
+            job_id = resp.json()["job_id"]
+            print(f"Waiting for revert {job_id}")
+            body = wait_for_revert(host_url, job_id)
+            print(body)
+            if body.get("status") != "done":
+                sys.exit(1)
+    except (ConnectionError, HTTPError, TimeoutError) as e:
         print(e)
         sys.exit(1)
 
@@ -0,0 +1,71 @@
+from unittest.mock import Mock, patch
+
+import pytest
+
+import ingest
+
+host_url = "http://0.0.0.0:5000"
+
+
+def status_response(body):
+    resp = Mock()
+    resp.json.return_value = body
+    return resp
+
+
+@patch("ingest.time.sleep")
+@patch("ingest._SESSION")
+def test_wait_for_revert_polls_until_done(mock_session, mock_sleep):
+    done = {"job_id": "abc", "status": "done", "revert_sha": "bar"}
+    mock_session.get.side_effect = [
+        status_response({"job_id": "abc", "status": "pending"}),
+        status_response(done),
+    ]
+    assert ingest.wait_for_revert(host_url, "abc") == done
+    mock_session.get.assert_called_with(f"{host_url}/api/revert/status/abc")
+    assert mock_session.get.call_count == 2
+    mock_sleep.assert_called_once_with(ingest.REVERT_POLL_INTERVAL)
+
+
+@patch("ingest.time.sleep")
+@patch("ingest._SESSION")
+def test_wait_for_revert_times_out(mock_session, mock_sleep, monkeypatch):
+    monkeypatch.setattr(ingest, "REVERT_POLL_TIMEOUT", -1)
+    mock_session.get.return_value = status_response({"status": "pending"})
+    with pytest.raises(TimeoutError):
+        ingest.wait_for_revert(host_url, "abc")
+
+
+def git_output(stdout):
+    execution = Mock()
+    execution.stdout = stdout
+    return execution
+
+
+@patch("ingest.run")
+def test_git_user_config(mock_run):
+    mock_run.return_value = git_output(
+        "user.name Jane Q Doe\nuser.email jane@example.com"
+    )
+    assert ingest.git_user_config() == {
+        "user.name": "Jane Q Doe",
+        "user.email": "jane@example.com",
+    }
+    mock_run.assert_called_once()
+
+
+@patch("ingest.run")
+def test_git_user_config_not_set(mock_run):
+    mock_run.side_effect = ingest.CommandError("")
+    assert ingest.git_user_config() == {}
+
+
+@patch("ingest.run")
+def test_git_author_email_falls_back_for_missing_key(mock_run):
+    mock_run.side_effect = [
+        git_output("user.name Jane Q Doe"),
+        git_output("jane@example.com"),
+    ]
+    assert ingest.git_author_email() == ("Jane Q Doe", "jane@example.com")
+    mock_run.assert_called_with("git config --global user.email", quiet=True)
+    assert mock_run.call_count == 2
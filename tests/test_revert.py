@@ -0,0 +1,97 @@
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from gitbot import deployhook
+
+payload = {"repo": "sentry", "sha": "foo", "name": "Jane Doe <jane@example.com>"}
+
+
+@pytest.fixture
+def client():
+    with deployhook.app.test_client() as client:
+        yield client
+
+
+def wait_for_job(client, job_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        body = client.get(f"/api/revert/status/{job_id}").get_json()
+        if body["status"] != "pending":
+            return body
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} did not finish")
+
+
+@patch("gitbot.deployhook.process_git_revert")
+def test_revert_is_queued_then_done(mock_revert, client):
+    started = threading.Event()
+    release = threading.Event()
+
+    def fake_revert(data):
+        started.set()
+        release.wait(5)
+        return {"reason": "foo reverted.", "revert_sha": "bar"}, 200
+
+    mock_revert.side_effect = fake_revert
+    resp = client.post("/api/revert", json=payload)
+    assert resp.status_code == 202
+    body = resp.get_json()
+    assert body["status"] == "pending"
+    job_id = body["job_id"]
+
+    assert started.wait(5)
+    resp = client.get(f"/api/revert/status/{job_id}")
+    assert resp.status_code == 200
+    assert resp.get_json()["status"] == "pending"
+
+    release.set()
+    assert wait_for_job(client, job_id) == {
+        "job_id": job_id,
+        "status": "done",
+        "reason": "foo reverted.",
+        "revert_sha": "bar",
+    }
+    mock_revert.assert_called_once_with(payload)
+
+
+@patch("gitbot.deployhook.process_git_revert")
+def test_failed_revert_status_is_still_200(mock_revert, client):
+    mock_revert.side_effect = deployhook.CommandError("conflict")
+    job_id = client.post("/api/revert", json=payload).get_json()["job_id"]
+    body = wait_for_job(client, job_id)
+    assert body["status"] == "failed"
+    assert body["reason"] == "Failed to revert."
+    assert client.get(f"/api/revert/status/{job_id}").status_code == 200
+
+
+def test_revert_unknown_repository(client):
+    resp = client.post("/api/revert", json={**payload, "repo": "foo"})
+    assert resp.status_code == 400
+
+
+def test_revert_status_unknown_job(client):
+    assert client.get("/api/revert/status/does-not-exist").status_code == 404
+
+
+def test_revert_jobs_are_evicted(monkeypatch):
+    monkeypatch.setattr(deployhook, "MAX_REVERT_JOBS", 2)
+    for job_id in ("a", "b", "c"):
+        deployhook._record_revert_job(job_id, ({"status": "done"}, 200))
+    assert list(deployhook._REVERT_JOBS) == ["b", "c"]
+
+
+def test_revert_payload_must_be_an_object(client):
+    resp = client.post("/api/revert", json=[1, 2])
+    assert resp.status_code == 400
+    assert resp.get_json()["reason"] == "Invalid JSON payload."
+
+
+def test_pending_revert_jobs_are_not_evicted(monkeypatch):
+    monkeypatch.setattr(deployhook, "MAX_REVERT_JOBS", 2)
+    deployhook._record_revert_job("a", ({"status": "pending"}, 202))
+    for job_id in ("b", "c", "d"):
+        deployhook._record_revert_job(job_id, ({"status": "done"}, 200))
+    assert list(deployhook._REVERT_JOBS) == ["a", "d"]
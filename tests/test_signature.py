@@ -0,0 +1,48 @@
+import hashlib
+import hmac
+
+from gitbot.deployhook import header_signature, valid_payload
+from gitbot.lib import hmac_sha1
+
+secret = "a-very-secret-value"
+
+
+def test_hmac_sha1_matches_stdlib():
+    payload = b'{"repo": "sentry", "sha": "foo", "name": "bar"}'
+    expected = hmac.new(secret.encode("utf-8"), payload, hashlib.sha1).hexdigest()
+    assert hmac_sha1(secret, payload).hexdigest() == expected
+
+
+def test_hmac_sha1_does_not_leak_state_between_calls():
+    first = hmac_sha1(secret, b"first").hexdigest()
+    hmac_sha1(secret, b"second")
+    assert hmac_sha1(secret, b"first").hexdigest() == first
+
+
+payload = b'{"ref": "refs/heads/master"}'
+expected_signature = hmac.new(secret.encode("utf-8"), payload, hashlib.sha1).hexdigest()
+
+
+def test_valid_payload_with_sha1_header():
+    signature = header_signature(f"sha1={expected_signature}")
+    assert signature == expected_signature
+    assert valid_payload(secret, payload, signature)
+
+
+def test_header_signature_without_prefix():
+    assert header_signature(expected_signature) == expected_signature
+    assert valid_payload(secret, payload, header_signature(expected_signature))
+
+
+def test_valid_payload_wrong_signature():
+    assert not valid_payload(secret, payload, "0" * len(expected_signature))
+    assert not valid_payload(secret, b"tampered", expected_signature)
+
+
+def test_valid_payload_wrong_length_signature():
+    assert not valid_payload(secret, payload, expected_signature[:-1])
+    assert not valid_payload(secret, payload, "")
+
+
+def test_valid_payload_non_ascii_signature():
+    assert not valid_payload(secret, payload, "é" * len(expected_signature))
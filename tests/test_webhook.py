@@ -0,0 +1,57 @@
+from unittest.mock import patch
+
+import pytest
+
+from gitbot import deployhook
+
+push_event = {
+    "ref": "refs/heads/master",
+    "repository": {"full_name": deployhook.SENTRY_REPO_UPSTREAM},
+    "head_commit": {"id": "foo"},
+}
+
+
+@pytest.fixture
+def client():
+    with deployhook.app.test_client() as client:
+        yield client
+
+
+@pytest.mark.parametrize(
+    "status_code, notify, level",
+    [
+        (200, None, None),
+        (400, None, None),
+        (400, False, None),
+        (400, True, "warning"),
+        (403, True, "warning"),
+        (500, None, "fatal"),
+        (500, False, None),
+        (502, True, "fatal"),
+    ],
+)
+@patch("gitbot.deployhook.sentry_sdk.capture_message")
+def test_respond_notify(mock_capture, status_code, notify, level):
+    with deployhook.app.app_context():
+        _, code = deployhook.respond("Some reason.", status_code, notify=notify)
+    assert code == status_code
+    if level is None:
+        mock_capture.assert_not_called()
+    else:
+        mock_capture.assert_called_once_with("Some reason.", level)
+
+
+@patch("gitbot.deployhook.sentry_sdk.capture_message")
+@patch("gitbot.deployhook.bump_version")
+def test_failed_push_bump_notifies(mock_bump, mock_capture, client):
+    mock_bump.return_value = (False, "Failed to push.")
+    resp = client.post("/", json=push_event, headers={"X-GitHub-Event": "push"})
+    assert resp.status_code == 400
+    mock_capture.assert_called_once_with("Failed to push.", "warning")
+
+
+@pytest.mark.parametrize("body", [b"payload=%7B%7D", b"[1, 2]", b'"foo"'])
+def test_index_rejects_payloads_that_are_not_json_objects(body, client):
+    resp = client.post("/", data=body, headers={"X-GitHub-Event": "push"})
+    assert resp.status_code == 400
+    assert resp.get_json()["reason"] == "Invalid JSON payload."